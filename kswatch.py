@@ -25,14 +25,31 @@
 
 import sys
 import os
+import re
 import time
-import urllib2
+import zlib
+import base64
+import hashlib
+import random
+import socket
+import urllib
+import urlparse
+import httplib
 import HTMLParser
 from optparse import OptionParser
 
 USER_KEY = "USER_KEY_HERE"
 APP_TOKEN = "APP_TOKEN_HERE"
 PRIORITY = 1
+TIMEOUT = 30    # Seconds to wait on a stalled connection before retrying
+RETRIES = 4     # Quick retries of a failed request before giving up on a poll
+MAX_REDIRECTS = 5
+
+# Identify ourselves the same way urllib2 did; some servers and CDNs
+# reject requests that don't have a User-Agent at all.
+USER_AGENT = 'Python-urllib/%d.%d' % sys.version_info[:2]
+
+NONDIGITS = re.compile(r'[^0-9.]+')  # Everything but the number in "$1,075.00"
 
 # Parse the pledge HTML page
 #
@@ -54,34 +71,164 @@ PRIORITY = 1
 
 
 class KickstarterHTMLParser(HTMLParser.HTMLParser):
-    def __init__(self):
+    def __init__(self, delay=60):
         HTMLParser.HTMLParser.__init__(self)
+        self.delay = delay  # Seconds between polls, the base for backing off
         self.in_li_block = False  # True == we're inside an <li class='...'> block
         self.in_desc_block = False  # True == we're inside a <p class="description short"> block
+        self.host = None  # The (scheme, host) that self.conn is connected to
+        self.conn = None  # Keep-alive connection, reused for every poll
+        self.prefix = ''  # Prepended to every request path (for HTTP proxies)
+        self.proxy_headers = {}  # Sent with every request (for HTTP proxies)
+        self.etag = None  # Validators from the last page we parsed, so that
+        self.last_modified = None  # an unchanged page comes back as a 304
+        self.digest = None  # Hash of the last page we parsed
+
+    # Open a connection to the scheme and host of a URL.  Like urllib2, go
+    # through the proxy named by $http_proxy or $https_proxy if there is one,
+    # unless the host is listed in $no_proxy.
+    def connect(self, parts):
+        if self.conn:
+            self.conn.close()
+        self.host = (parts.scheme, parts.netloc)
+        self.prefix = ''
+        self.proxy_headers = {}
+        if parts.scheme == 'http':
+            connection = httplib.HTTPConnection
+        else:
+            connection = httplib.HTTPSConnection
+
+        proxy = urllib.getproxies().get(parts.scheme)
+        if not proxy or urllib.proxy_bypass(parts.hostname):
+            self.conn = connection(parts.netloc, timeout=TIMEOUT)
+            return
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy = urlparse.urlsplit(proxy)
+        headers = {}
+        if proxy.username:
+            credentials = '%s:%s' % (urllib.unquote(proxy.username),
+                                     urllib.unquote(proxy.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        proxy_host = proxy.hostname
+        if proxy.port:
+            proxy_host += ':%u' % proxy.port
+
+        if parts.scheme == 'http':
+            # Plain HTTP requests go to the proxy with the full URL as the path
+            self.conn = httplib.HTTPConnection(proxy_host, timeout=TIMEOUT)
+            self.prefix = 'http://' + parts.netloc
+            self.proxy_headers = headers
+        else:
+            # HTTPS is tunnelled through the proxy with CONNECT
+            self.conn = httplib.HTTPSConnection(proxy_host, timeout=TIMEOUT)
+            self.conn.set_tunnel(parts.netloc, headers=headers)
+
+    # Send a GET over the persistent connection.  Connection errors and 5xx
+    # responses are retried a few times with a short exponential backoff.
+    # A failure on a reused connection doesn't count as one of those
+    # retries: with polls a minute or more apart, the server has usually
+    # dropped the idle connection since the last poll, so just try again
+    # at once on a fresh one.
+    def get(self, path):
+        headers = {'Accept-Encoding': 'gzip', 'User-Agent': USER_AGENT}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        headers.update(self.proxy_headers)
+
+        attempt = 0
+        while True:
+            reused = self.conn.sock is not None
+            try:
+                self.conn.request('GET', path, headers=headers)
+                response = self.conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.conn.close()
+                if reused:
+                    continue
+                if attempt == RETRIES:
+                    raise
+            else:
+                if response.status < 500 or attempt == RETRIES:
+                    return response, body
+
+            attempt += 1
+            if attempt > 1:
+                time.sleep(0.5 * 2 ** (attempt - 1))
+
+    # Fetch a page over the persistent connection, following any redirects.
+    # Returns the response and its (decompressed) body.
+    def fetch(self, url):
+        for _ in range(MAX_REDIRECTS):
+            parts = urlparse.urlsplit(url)
+            if (parts.scheme, parts.netloc) != self.host:
+                self.connect(parts)
+            path = self.prefix + (parts.path or '/')
+            if parts.query:
+                path += '?' + parts.query
+
+            response, body = self.get(path)
+            if response.status not in (301, 302, 303, 307, 308):
+                if response.getheader('content-encoding') == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                return response, body
+            url = urlparse.urljoin(url, response.getheader('location'))
+
+        raise httplib.HTTPException('Too many redirects')
 
     def process(self, url):
+        errors = 0
         while True:
             try:
-                f = urllib2.urlopen(url)
-                break
-            except urllib2.HTTPError as e:
-                print 'HTTP Error', e
-            except urllib2.URLError as e:
-                print 'URL Error', e
+                response, html = self.fetch(url)
+                if response.status == 304:
+                    return self.rewards  # Unchanged since the last poll
+                if response.status == 200:
+                    break
+                print 'HTTP Error', response.status, response.reason
+            except (httplib.HTTPException, socket.error) as e:
+                print 'Connection Error', e
             except Exception as e:
                 print 'General Error', e
 
-            print 'Retrying in one minute'
-            time.sleep(60)
-
-        html = unicode(f.read(), 'utf-8')
-        f.close()
+            # Back off exponentially from the polling interval, up to an hour
+            # (or the interval itself, if that's longer), with some jitter so
+            # that we don't retry in lockstep with the outage.
+            errors += 1
+            delay = min(max(60 * 60, self.delay), self.delay * 2 ** errors)
+            delay += random.uniform(0, self.delay / 2.0)
+            print 'Retrying in %u seconds' % delay
+            time.sleep(delay)
+
+        self.etag = response.getheader('etag')
+        self.last_modified = response.getheader('last-modified')
+
+        # Many servers don't support conditional GETs, but the page is still
+        # usually byte-for-byte identical to the last one.
+        digest = hashlib.sha1(html).digest()
+        if digest == self.digest:
+            return self.rewards
+        self.digest = digest
+
+        html = unicode(html, 'utf-8')
         self.rewards = []
         self.feed(html)  # feed() starts the HTMLParser parsing
         return self.rewards
 
     def handle_starttag(self, tag, attributes):
-        global status
+        # Only <li>, <input>, and <h3> tags matter, and the latter two only
+        # inside a reward block, so skip everything else before building the
+        # attribute dictionary.  Note that this deliberately only recognizes
+        # the pledge__title class on <h3>, which is the markup Kickstarter
+        # uses; the class on any other tag is ignored.
+        if tag not in ('li', 'input', 'h3'):
+            return
+        if tag != 'li' and not self.in_li_block:
+            return
 
         attrs = dict(attributes)
 
@@ -96,39 +243,36 @@ class KickstarterHTMLParser(HTMLParser.HTMLParser):
 
         # Extract the pledge amount (the cost)
         if self.in_li_block and tag == 'input' and 'pledge__radio' in attrs['class']:
-            # remove everything except the actual number
-            amount = attrs['title'].encode('ascii', 'ignore')
-            nondigits = amount.translate(None, '0123456789.')
-            amount = amount.translate(None, nondigits)
-            # Convert the value into a float
-            self.value = float(amount)
+            # Remove everything except the actual number, and convert it
+            # into a float
+            self.value = float(NONDIGITS.sub('', attrs['title']))
             self.ident = attrs['id']  # Save the reward ID
 
         # We only care about certain kinds of reward levels -- those that
         # are limited.
         if tag == 'li' and 'pledge--all-gone' in attrs['class']:
             self.in_li_block = True
-            self.description = ''
+            self.description = []
 
     def handle_endtag(self, tag):
         if tag == 'li':
             if self.in_li_block:
+                description = u''.join(self.description).encode('ascii', 'ignore')
                 self.rewards.append((self.value,
                                      self.ident,
-                                     ' '.join(self.description.split())))
+                                     ' '.join(description.split())))
             self.in_li_block = False
         if tag == 'h3':
             self.in_desc_block = False
 
     def handle_data(self, data):
         if self.in_desc_block:
-            self.description += self.unescape(data).encode('ascii', 'ignore')
+            self.description.append(data)
 
     def result(self):
         return self.rewards
 
 def push_message(message, url):
-    import httplib, urllib
     conn = httplib.HTTPSConnection("api.pushover.net:443")
     conn.request("POST", "/1/messages.json",
                  urllib.urlencode({
@@ -141,8 +285,6 @@ def push_message(message, url):
     conn.getresponse()
 
 def pledge_menu(rewards):
-    import re
-
     count = len(rewards)
 
     # If there is only one qualifying pledge level, then just select it
@@ -157,80 +299,105 @@ def pledge_menu(rewards):
     while True:
         try:
             ans = raw_input('\nSelect pledge levels: ')
-            numbers = map(int, ans.split())
+            numbers = [int(n) for n in ans.split()]
+            if any(n < 1 for n in numbers):
+                continue  # rewards[-1] would silently pick the last pledge
             return [rewards[i - 1] for i in numbers]
-        except (IndexError, NameError, SyntaxError):
+        except (IndexError, ValueError):
             continue
 
-parser = OptionParser(usage="usage: %prog [options] project-url [cost-of-pledge ...]\n"
-                      "project-url is the URL of the Kickstarter project\n"
-                      "cost-of-pledge is the cost of the target pledge.\n"
-                      "If cost-of-pledge is not specified, then a menu of pledges is shown.\n"
-                      "Specify cost-of-pledge only if that amount is unique among pledges.\n"
-                      "Only restricted pledges are supported.")
-parser.add_option("-d", dest="delay",
-    help="delay, in minutes, between each check (default is 1)",
-    type="int", default=1)
-parser.add_option("-v", dest="verbose",
-    help="print a message before each delay",
-    action="store_true", default=False)
-
-(options, args) = parser.parse_args()
-
-if len(args) < 1:
-    parser.error('no URL specified')
-    sys.exit(0)
-
-# Generate the URL
-url = args[0].split('?', 1)[0]  # drop the stuff after the ?
-url += '/pledge/new' # we want the pledge-editing page
-pledges = None   # The pledge amounts on the command line
-ids = None       # A list of IDs of the pledge levels
-selected = None  # A list of selected pledge levels
-rewards = None  # A list of valid reward levels
-if len(sys.argv) > 2:
-    pledges = map(float, args[1:])
-
-ks = KickstarterHTMLParser()
-
-rewards = ks.process(url)
-if not rewards:
-    print 'No unavailable limited rewards for this Kickstarter'
-    sys.exit(0)
-
-# Select the pledge level(s)
-if pledges:
-    selected = [r for r in rewards if r[0] in pledges]
-else:
-    # If a pledge amount was not specified on the command-line, then prompt
-    # the user with a menu
-    selected = pledge_menu(rewards)
-
-if not selected:
-    print 'No reward selected.'
-    sys.exit(0)
-
-print '\nSelected rewards:'
-for s in selected:
-    print s[2]
-
-print '\nSending test push to make sure everything is OK'
-push_message('This is a Test!', url)
-
-print '\nWatching...'
-while True:
+def main():
+    parser = OptionParser(usage="usage: %prog [options] project-url [cost-of-pledge ...]\n"
+                          "project-url is the URL of the Kickstarter project\n"
+                          "cost-of-pledge is the cost of the target pledge.\n"
+                          "If cost-of-pledge is not specified, then a menu of pledges is shown.\n"
+                          "Specify cost-of-pledge only if that amount is unique among pledges.\n"
+                          "Only restricted pledges are supported.")
+    parser.add_option("-d", dest="delay",
+        help="delay, in minutes, between each check (default is 1)",
+        type="int", default=1)
+    parser.add_option("-v", dest="verbose",
+        help="print a message before each delay",
+        action="store_true", default=False)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.error('no URL specified')
+        sys.exit(0)
+
+    # Generate the URL
+    url = args[0].split('?', 1)[0]  # drop the stuff after the ?
+    url += '/pledge/new' # we want the pledge-editing page
+    pledges = None   # The set of pledge amounts on the command line
+    ids = None       # The set of IDs of the unavailable pledge levels
+    selected = None  # A list of selected pledge levels
+    rewards = None  # A list of valid reward levels
+    if len(args) > 1:
+        pledges = {float(p) for p in args[1:]}
+
+    ks = KickstarterHTMLParser(60 * options.delay)
+
+    rewards = ks.process(url)
+    if not rewards:
+        print 'No unavailable limited rewards for this Kickstarter'
+        sys.exit(0)
+
+    # Select the pledge level(s)
+    if pledges:
+        selected = [r for r in rewards if r[0] in pledges]
+    else:
+        # If a pledge amount was not specified on the command-line, then prompt
+        # the user with a menu
+        selected = pledge_menu(rewards)
+
+    if not selected:
+        print 'No reward selected.'
+        sys.exit(0)
+
+    print '\nSelected rewards:'
     for s in selected:
-        if not s[1] in [r[1] for r in rewards]:
-            print '%s - Reward available!' % time.strftime('%B %d, %Y %I:%M %p')
-            print s[2]
-            push_message('Kickstarter Reward available!', url)
-            selected = [x for x in selected if x != s]  # Remove the pledge we just found
+        print s[2]
+
+    print '\nSending test push to make sure everything is OK'
+    push_message('This is a Test!', url)
+
+    print '\nWatching...'
+    deadline = time.time()  # When the current poll was scheduled to start
+    while True:
+        ids = {r[1] for r in rewards}
+        available = []  # Indexes of the selected pledges that became available
+        for i, s in enumerate(selected):
+            if s[1] not in ids:
+                print '%s - Reward available!' % time.strftime('%B %d, %Y %I:%M %p')
+                print s[2]
+                available.append(i)
+        if available:
+            # Send a single notification for everything we found in this poll.
+            # Pushover messages are limited to 1024 characters.
+            message = '\n'.join(['Kickstarter Reward available!'] +
+                                [selected[i][2] for i in available])
+            push_message(message[:1024], url)
+            for i in reversed(available):  # Remove the pledges we just found
+                del selected[i]
             if not selected:  # If there are no more pledges to check, then exit
                 time.sleep(10)  # Give the web browser time to open
                 sys.exit(0)
-            break
-    if options.verbose:
-        print 'Waiting %u minutes ...' % options.delay
-    time.sleep(60 * options.delay)
-
-    rewards = ks.process(url)
+        if options.verbose:
+            print 'Waiting %u minutes ...' % options.delay
+
+        # Schedule the next poll relative to when this one was due, so that
+        # the time spent fetching and parsing doesn't stretch the interval.
+        # If a long retry in process() made us miss the slot entirely, or the
+        # system clock was changed (Python 2 has no monotonic clock), wait a
+        # full interval from now instead, so we never poll early.
+        deadline += 60 * options.delay
+        now = time.time()
+        if not now < deadline <= now + 60 * options.delay:
+            deadline = now + 60 * options.delay
+        time.sleep(deadline - now)
+
+        rewards = ks.process(url)
+
+if __name__ == "__main__":
+    main()